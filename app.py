@@ -1,12 +1,15 @@
-from flask import Flask, request, jsonify, render_template, session
+from flask import Flask, Response, request, jsonify, render_template, session
 from flask_cors import CORS
+from werkzeug.middleware.proxy_fix import ProxyFix
 import os
 from dotenv import load_dotenv
 import requests
 from database import db
+from rate_limit import create_rate_limiter, too_many_requests
 import uuid
 import json
 from datetime import timedelta
+from concurrent.futures import ThreadPoolExecutor
 
 # Load environment variables
 load_dotenv()
@@ -17,6 +20,11 @@ app = Flask(__name__, static_folder='static', template_folder='templates')
 ENVIRONMENT = os.getenv('ENVIRONMENT', os.getenv('FLASK_ENV', 'development')).lower()
 app.secret_key = os.getenv('SECRET_KEY', 'your-secret-key-change-this-in-production')
 
+# Trust X-Forwarded-* from this many proxy hops (e.g. 1 behind Render) so remote_addr is the real client
+TRUSTED_PROXY_HOPS = int(os.getenv('TRUSTED_PROXY_HOPS', '0'))
+if TRUSTED_PROXY_HOPS > 0:
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=TRUSTED_PROXY_HOPS, x_proto=TRUSTED_PROXY_HOPS)
+
 # Session cookie hardening
 app.config['SESSION_COOKIE_HTTPONLY'] = True
 app.config['SESSION_COOKIE_SAMESITE'] = os.getenv('SESSION_COOKIE_SAMESITE', 'Lax')
@@ -29,6 +37,20 @@ CORS(app, resources={r"/api/*": {"origins": allowed_origins}}, supports_credenti
 
 # Configuration
 GEMINI_API_KEY = os.getenv('GEMINI_API_KEY')
+UPSTREAM_RETRY_AFTER = int(os.getenv('UPSTREAM_RETRY_AFTER', '5'))
+BATCH_MAX_ITEMS = int(os.getenv('BATCH_MAX_ITEMS', '20'))
+AI_SERVICES = ('auto', 'gemini', 'deepseek')
+
+# Per-route token buckets plus a cap on concurrent upstream calls
+limiter = create_rate_limiter(db)
+
+# Shared pool for /api/chat/batch fan-out; bounded so one batch cannot exhaust threads.
+# Batches are capped at the pool size so every item runs in a single round.
+BATCH_MAX_WORKERS = int(os.getenv('BATCH_MAX_WORKERS', str(limiter.max_inflight)))
+BATCH_MAX_ITEMS = min(BATCH_MAX_ITEMS, BATCH_MAX_WORKERS)
+# Batch items may wait this long for an upstream slot held by another request before failing
+BATCH_SLOT_WAIT = float(os.getenv('BATCH_SLOT_WAIT', '2'))
+batch_executor = ThreadPoolExecutor(max_workers=BATCH_MAX_WORKERS, thread_name_prefix='chat-batch')
 
 print("🚀 Simple AI Chatbot Starting...")
 print(f"  Gemini API: {'✅ Ready' if GEMINI_API_KEY else '❌ Not configured'}")
@@ -88,6 +110,44 @@ def get_backup_response(message):
     else:
         return f"I understand you said: '{message}'. I'm a simple backup AI. For better responses, try the Gemini AI option!"
 
+def generate_response(message, service):
+    """Answer with the preferred service, falling back to the backup AI"""
+    if service == 'deepseek':
+        return get_backup_response(message), 'Backup AI'
+    
+    response = get_gemini_response(message)
+    if response:
+        return response, 'Gemini AI'
+    
+    if service == 'gemini':
+        return get_backup_response(message), 'Backup AI (Gemini failed)'
+    return get_backup_response(message), 'Backup AI'
+
+def uses_upstream(service):
+    """Mirrors generate_response: everything but the backup-only service may call Gemini"""
+    return bool(GEMINI_API_KEY) and service != 'deepseek'
+
+def run_batch_item(message, service):
+    """Worker-pool task for one batch item; returns None when shed for upstream load"""
+    slot = limiter.try_acquire_upstream(BATCH_SLOT_WAIT) if uses_upstream(service) else None
+    if uses_upstream(service) and slot is None:
+        return None
+    try:
+        return generate_response(message, service)
+    finally:
+        if slot is not None:
+            limiter.release_upstream(slot)
+
+def conditional_response(etag, build):
+    """Answer 304 if the client already holds ``etag``; otherwise ``build()`` the full response"""
+    if request.if_none_match.contains_weak(etag):
+        response = Response(status=304)
+    else:
+        response = build()
+    response.set_etag(etag, weak=True)
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response
+
 @app.route('/')
 def index():
     # Initialize user session if not exists
@@ -101,18 +161,32 @@ def index():
 
 @app.route('/api/health', methods=['GET'])
 def health():
-    return jsonify({'status': 'healthy', 'message': 'Simple AI Chatbot is running!'})
+    return conditional_response(
+        'health', lambda: jsonify({'status': 'healthy', 'message': 'Simple AI Chatbot is running!'})
+    )
 
 @app.route('/api/chat', methods=['POST'])
+@limiter.limit('chat')
 def chat():
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict):
+        return jsonify({'error': 'Request body must be a JSON object'}), 400
+    
+    message = data.get('message', '')
+    service = data.get('preferred_service', 'auto')
+    
+    if not isinstance(message, str) or not message.strip():
+        return jsonify({'error': 'No message provided'}), 400
+    if service not in AI_SERVICES:
+        return jsonify({'error': f"preferred_service must be one of: {', '.join(AI_SERVICES)}"}), 400
+    message = message.strip()
+    
+    # Shed load instead of queueing when every upstream slot is busy
+    slot = limiter.try_acquire_upstream() if uses_upstream(service) else None
+    if uses_upstream(service) and slot is None:
+        return too_many_requests(UPSTREAM_RETRY_AFTER, 'Server is busy, please retry shortly.')
+    
     try:
-        data = request.get_json()
-        message = data.get('message', '').strip()
-        service = data.get('preferred_service', 'auto')
-        
-        if not message:
-            return jsonify({'error': 'No message provided'}), 400
-        
         # Get or create user session
         if 'user_id' not in session:
             session['user_id'] = db.create_user()
@@ -126,36 +200,112 @@ def chat():
         # Save user message to database
         db.save_message(session_id, 'user', message, {'service': service})
         
-        # Try services based on preference
-        if service == 'gemini':
-            response = get_gemini_response(message)
-            if response:
-                # Save AI response to database
-                db.save_message(session_id, 'ai', response, {'service': 'Gemini AI'})
-                return jsonify({'response': response, 'service': 'Gemini AI'})
-            else:
-                response = get_backup_response(message)
-                db.save_message(session_id, 'ai', response, {'service': 'Backup AI (Gemini failed)'})
-                return jsonify({'response': response, 'service': 'Backup AI (Gemini failed)'})
-        
-        elif service == 'deepseek':
-            response = get_backup_response(message)
-            db.save_message(session_id, 'ai', response, {'service': 'Backup AI'})
-            return jsonify({'response': response, 'service': 'Backup AI'})
-        
-        else:  # auto
-            response = get_gemini_response(message)
-            if response:
-                db.save_message(session_id, 'ai', response, {'service': 'Gemini AI'})
-                return jsonify({'response': response, 'service': 'Gemini AI'})
-            else:
-                response = get_backup_response(message)
-                db.save_message(session_id, 'ai', response, {'service': 'Backup AI'})
-                return jsonify({'response': response, 'service': 'Backup AI'})
+        response, service_name = generate_response(message, service)
+        db.save_message(session_id, 'ai', response, {'service': service_name})
+        return jsonify({'response': response, 'service': service_name})
     
     except Exception as e:
         print(f"Chat error: {e}")
         return jsonify({'response': 'Sorry, something went wrong. Please try again.', 'service': 'Error Handler'})
+    
+    finally:
+        if slot is not None:
+            limiter.release_upstream(slot)
+
+@app.route('/api/chat/batch', methods=['POST'])
+@limiter.limit('batch')
+def chat_batch():
+    """Answer several messages at once, fanning upstream calls out over a worker pool"""
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict):
+        return jsonify({'error': 'Request body must be a JSON object'}), 400
+    
+    items = data.get('messages')
+    default_service = data.get('preferred_service', 'auto')
+    
+    if not isinstance(items, list) or not items:
+        return jsonify({'error': 'No messages provided'}), 400
+    if default_service not in AI_SERVICES:
+        return jsonify({'error': f"preferred_service must be one of: {', '.join(AI_SERVICES)}"}), 400
+    
+    max_items = min(BATCH_MAX_ITEMS, limiter.capacity('chat') or BATCH_MAX_ITEMS)
+    if len(items) > max_items:
+        return jsonify({'error': f'At most {max_items} messages per batch'}), 400
+    
+    # Every item counts against the same per-user chat limit as /api/chat
+    allowed, retry_after = limiter.check('chat', cost=len(items))
+    if not allowed:
+        return too_many_requests(retry_after)
+    
+    try:
+        if 'user_id' not in session:
+            session['user_id'] = db.create_user()
+        
+        if 'session_id' not in session:
+            session['session_id'] = db.create_chat_session(session['user_id'])
+        
+        owned_sessions = set(db.get_user_session_ids(session['user_id']))
+        results = [None] * len(items)
+        pending = []
+        
+        for index, item in enumerate(items):
+            if not isinstance(item, dict):
+                results[index] = {'index': index, 'error': 'Each item must be a JSON object'}
+                continue
+            
+            message = item.get('message')
+            service = item.get('preferred_service', default_service)
+            target_session = item.get('session_id', session['session_id'])
+            
+            if not isinstance(message, str) or not message.strip():
+                results[index] = {'index': index, 'error': 'No message provided'}
+            elif service not in AI_SERVICES:
+                results[index] = {'index': index, 'error': f"preferred_service must be one of: {', '.join(AI_SERVICES)}"}
+            elif type(target_session) is not int or target_session not in owned_sessions:
+                results[index] = {'index': index, 'error': 'Session not found or access denied'}
+            else:
+                message = message.strip()
+                future = batch_executor.submit(run_batch_item, message, service)
+                pending.append((index, message, service, target_session, future))
+        
+        to_save = []
+        for index, message, service, target_session, future in pending:
+            try:
+                outcome = future.result()
+            except Exception as e:
+                print(f"Batch item error: {e}")
+                outcome = None
+                results[index] = {'index': index, 'session_id': target_session, 'error': 'Failed to generate response'}
+            
+            if outcome is None:
+                if results[index] is None:
+                    results[index] = {
+                        'index': index,
+                        'session_id': target_session,
+                        'error': 'Server is busy, please retry shortly.',
+                        'retry_after': UPSTREAM_RETRY_AFTER,
+                    }
+                continue
+            
+            response, service_name = outcome
+            results[index] = {
+                'index': index,
+                'session_id': target_session,
+                'response': response,
+                'service': service_name,
+            }
+            to_save.append({'session_id': target_session, 'message_type': 'user', 'content': message, 'metadata': {'service': service}})
+            to_save.append({'session_id': target_session, 'message_type': 'ai', 'content': response, 'metadata': {'service': service_name}})
+        
+        # One transaction for the whole batch
+        if to_save:
+            db.save_messages(to_save)
+        
+        return jsonify({'results': results})
+    
+    except Exception as e:
+        print(f"Batch chat error: {e}")
+        return jsonify({'error': 'Failed to process batch'}), 500
 
 @app.route('/api/history', methods=['GET'])
 def get_chat_history():
@@ -167,8 +317,15 @@ def get_chat_history():
         session_id = session['session_id']
         limit = request.args.get('limit', 50, type=int)
         
-        history = db.get_chat_history(session_id, limit)
-        return jsonify({'history': history})
+        # The version token is a primary-key lookup, so unchanged history never hits the messages table
+        token = db.get_version(f'session:{session_id}')
+        
+        def build():
+            return Response(db.get_chat_history_json(session_id, limit), mimetype='application/json')
+        
+        if token is None:
+            return build()
+        return conditional_response(f"h-{token}-{limit}", build)
     
     except Exception as e:
         print(f"History error: {e}")
@@ -182,14 +339,22 @@ def get_user_sessions():
             return jsonify({'sessions': []})
         
         user_id = session['user_id']
-        sessions = db.get_user_sessions(user_id)
-        return jsonify({'sessions': sessions})
+        # Listings come from the replica; take the token from it first so the ETag never outruns the body
+        token = db.get_version(f'user:{user_id}', use_replica=True)
+        
+        def build():
+            return Response(db.get_user_sessions_json(user_id), mimetype='application/json')
+        
+        if token is None:
+            return build()
+        return conditional_response(f"s-{token}", build)
     
     except Exception as e:
         print(f"Sessions error: {e}")
         return jsonify({'error': 'Failed to retrieve sessions'}), 500
 
 @app.route('/api/sessions', methods=['POST'])
+@limiter.limit('sessions')
 def create_new_session():
     """Create a new chat session"""
     try:
@@ -218,9 +383,8 @@ def switch_session(session_id):
         if 'user_id' not in session:
             return jsonify({'error': 'No user session'}), 400
         
-        # Verify session belongs to user
-        user_sessions = db.get_user_sessions(session['user_id'])
-        session_ids = [s['id'] for s in user_sessions]
+        # Verify session belongs to user (primary read, so just-created sessions are visible)
+        session_ids = db.get_user_session_ids(session['user_id'])
         
         if session_id not in session_ids:
             return jsonify({'error': 'Session not found or access denied'}), 404
@@ -239,9 +403,8 @@ def delete_session(session_id):
         if 'user_id' not in session:
             return jsonify({'error': 'No user session'}), 400
         
-        # Verify session belongs to user
-        user_sessions = db.get_user_sessions(session['user_id'])
-        session_ids = [s['id'] for s in user_sessions]
+        # Verify session belongs to user (primary read, so just-created sessions are visible)
+        session_ids = db.get_user_session_ids(session['user_id'])
         
         if session_id not in session_ids:
             return jsonify({'error': 'Session not found or access denied'}), 404
@@ -271,9 +434,8 @@ def rename_session(session_id):
         if not new_name:
             return jsonify({'error': 'Name is required'}), 400
         
-        # Verify session belongs to user
-        user_sessions = db.get_user_sessions(session['user_id'])
-        session_ids = [s['id'] for s in user_sessions]
+        # Verify session belongs to user (primary read, so just-created sessions are visible)
+        session_ids = db.get_user_session_ids(session['user_id'])
         
         if session_id not in session_ids:
             return jsonify({'error': 'Session not found or access denied'}), 404
@@ -290,6 +452,7 @@ def get_database_stats():
     """Get database statistics"""
     try:
         stats = db.get_database_stats()
+        stats['pools'] = db.get_pool_stats()
         
         # Add user-specific stats
         if 'user_id' in session:
@@ -324,10 +487,12 @@ def get_current_session():
         if 'session_id' not in session:
             return jsonify({'session_id': None})
         
-        return jsonify({
-            'session_id': session['session_id'],
-            'user_id': session.get('user_id')
-        })
+        session_id = session['session_id']
+        user_id = session.get('user_id')
+        return conditional_response(
+            f"cs-{session_id}-{user_id}",
+            lambda: jsonify({'session_id': session_id, 'user_id': user_id})
+        )
     
     except Exception as e:
         print(f"Get current session error: {e}")
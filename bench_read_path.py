@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+"""
+Micro-benchmark: ORM history/session reads + jsonify vs the Core JSON read path
+"""
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+# Point the module-level database at a scratch file before importing it
+tmp_dir = tempfile.mkdtemp(prefix="chatbot-bench-")
+os.environ.pop("DATABASE_URL", None)
+os.environ["DATABASE_PATH"] = os.path.join(tmp_dir, "bench.db")
+
+from flask import Flask  # noqa: E402
+
+from database import Message, db  # noqa: E402
+
+# Same JSON provider and response class the app's jsonify uses
+json_app = Flask(__name__)
+
+MESSAGES = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+SESSIONS = 200
+ROUNDS = 20
+
+
+def seed(database):
+    user_id = database.create_user("BenchUser")
+    session_ids = [database.create_chat_session(user_id, f"Chat {i}") for i in range(SESSIONS)]
+    history_session = session_ids[0]
+    with database.SessionLocal() as s:
+        s.add_all(
+            Message(
+                session_id=history_session,
+                message_type="user" if i % 2 == 0 else "ai",
+                content=f"Message {i}: " + "lorem ipsum dolor sit amet " * 8,
+                message_metadata=json.dumps({"service": "Gemini AI", "tokens": i}),
+            )
+            for i in range(MESSAGES)
+        )
+        s.commit()
+    return user_id, history_session
+
+
+def bench(label, fn, rows):
+    fn()  # warm up
+    start = time.perf_counter()
+    for _ in range(ROUNDS):
+        fn()
+    elapsed = time.perf_counter() - start
+    rate = rows * ROUNDS / elapsed
+    print(f"  {label:<28} {elapsed / ROUNDS * 1000:8.2f} ms/call  {rate:12,.0f} rows/sec")
+    return rate
+
+
+def json_response(body):
+    return json_app.response_class(body, mimetype="application/json")
+
+
+def main():
+    database = db
+    try:
+        user_id, history_session = seed(database)
+
+        print(f"📝 History ({MESSAGES} rows)")
+        old = bench(
+            "ORM + jsonify",
+            lambda: json_app.json.response({"history": database.get_chat_history(history_session, MESSAGES)}),
+            MESSAGES,
+        )
+        new = bench(
+            "Core JSON read path",
+            lambda: json_response(database.get_chat_history_json(history_session, MESSAGES)),
+            MESSAGES,
+        )
+        print(f"  speedup: {new / old:.2f}x")
+
+        print(f"💬 Sessions ({SESSIONS} rows)")
+        old = bench(
+            "ORM + jsonify",
+            lambda: json_app.json.response({"sessions": database.get_user_sessions(user_id)}),
+            SESSIONS,
+        )
+        new = bench("Core JSON read path", lambda: json_response(database.get_user_sessions_json(user_id)), SESSIONS)
+        print(f"  speedup: {new / old:.2f}x")
+    finally:
+        database.engine.dispose()
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,18 +1,35 @@
 import json
 import os
+import threading
+import uuid
 import datetime as dt
 from typing import List, Dict, Optional
 
+from json.encoder import encode_basestring_ascii
 from sqlalchemy import (
-    create_engine, String, Text, ForeignKey, DateTime, func, UniqueConstraint
+    create_engine, event, String, Text, ForeignKey, DateTime, Float, func, UniqueConstraint, update, select, delete
 )
 from sqlalchemy.orm import (
     declarative_base, relationship, sessionmaker, Mapped, mapped_column
 )
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.engine import make_url
 from sqlalchemy.exc import IntegrityError
+from sqlalchemy.pool import QueuePool
 
 Base = declarative_base()
 
+# Dialects with INSERT ... ON CONFLICT DO UPDATE
+_UPSERT_INSERTS = {"postgresql": postgresql.insert, "sqlite": sqlite.insert}
+
+
+def _json_str(value) -> str:
+    return encode_basestring_ascii(value) if value is not None else 'null'
+
+
+def _json_time(value) -> str:
+    return '"' + value.isoformat() + '"' if value is not None else 'null'
+
 
 class User(Base):
     __tablename__ = "users"
@@ -64,26 +81,134 @@ class UserSetting(Base):
         {"sqlite_autoincrement": True},
     )
 
+
+class RateLimitBucket(Base):
+    __tablename__ = "rate_limit_buckets"
+    bucket_key: Mapped[str] = mapped_column(String, primary_key=True)
+    tokens: Mapped[float] = mapped_column(Float, nullable=False)
+    updated_at: Mapped[float] = mapped_column(Float, nullable=False)
+
+
+class UpstreamSlot(Base):
+    """One concurrent upstream call, leased until ``lease_until`` so a crashed worker cannot hold it forever"""
+    __tablename__ = "upstream_slots"
+    slot_id: Mapped[int] = mapped_column(primary_key=True, autoincrement=False)
+    holder: Mapped[Optional[str]] = mapped_column(String, nullable=True)
+    lease_until: Mapped[float] = mapped_column(Float, nullable=False, default=0.0)
+
+
+class CacheVersion(Base):
+    """Opaque token per cache scope (``session:<id>`` / ``user:<id>``), replaced on every write"""
+    __tablename__ = "cache_versions"
+    scope: Mapped[str] = mapped_column(String, primary_key=True)
+    token: Mapped[str] = mapped_column(String, nullable=False)
+
+
+def _engine_options(url: str) -> Dict:
+    """Pool settings from the environment, for backends that pool with QueuePool.
+
+    Others (e.g. in-memory SQLite on SingletonThreadPool) keep their dialect's default pool.
+    """
+    options: Dict = {"pool_pre_ping": True}
+    parsed = make_url(url)
+    if issubclass(parsed.get_dialect().get_pool_class(parsed), QueuePool):
+        options.update(
+            pool_size=int(os.getenv("DB_POOL_SIZE", "5")),
+            max_overflow=int(os.getenv("DB_MAX_OVERFLOW", "10")),
+            pool_timeout=int(os.getenv("DB_POOL_TIMEOUT", "30")),
+            pool_recycle=int(os.getenv("DB_POOL_RECYCLE", "1800")),
+        )
+    return options
+
+
 class ChatDatabase:
+    """Chat storage with optional read replica.
+
+    Writes and reads that must see the caller's own writes (history, ownership checks,
+    cache version tokens, rate limits, settings) use the primary engine. Session listings
+    and statistics use ``replica_engine``, which is the primary unless
+    ``DATABASE_REPLICA_URL`` is set.
+    """
+
     def __init__(self, db_path: str = "chatbot.db"):
         url = os.getenv("DATABASE_URL")
         if url:
-            self.engine = create_engine(url, pool_pre_ping=True)
             self.using_url = url
         else:
             # Allow overriding via environment variable path for local SQLite
             env_db = os.getenv("DATABASE_PATH") or db_path
             self.using_url = f"sqlite:///{env_db}"
-            self.engine = create_engine(self.using_url, pool_pre_ping=True)
+        self.pool_options = {"primary": _engine_options(self.using_url)}
+        self.engine = create_engine(self.using_url, **self.pool_options["primary"])
+        self.pool_metrics = {"primary": self._track_pool(self.engine)}
+        
+        replica_url = os.getenv("DATABASE_REPLICA_URL")
+        if replica_url:
+            self.pool_options["replica"] = _engine_options(replica_url)
+            self.replica_engine = create_engine(replica_url, **self.pool_options["replica"])
+            self.pool_metrics["replica"] = self._track_pool(self.replica_engine)
+        else:
+            self.replica_engine = self.engine
+        
         self.SessionLocal = sessionmaker(bind=self.engine, expire_on_commit=False)
+        self.ReplicaSession = sessionmaker(bind=self.replica_engine, expire_on_commit=False)
         self.init_database()
 
+    @staticmethod
+    def _track_pool(engine) -> Dict:
+        """Count checkouts and, for QueuePool, the highest number of connections out at once"""
+        metrics = {"checkouts": 0, "peak_checked_out": 0}
+        lock = threading.Lock()
+
+        @event.listens_for(engine, "checkout")
+        def on_checkout(*_):
+            with lock:
+                metrics["checkouts"] += 1
+                if isinstance(engine.pool, QueuePool):
+                    metrics["peak_checked_out"] = max(metrics["peak_checked_out"], engine.pool.checkedout())
+
+        return metrics
+
+    @property
+    def has_replica(self) -> bool:
+        return self.replica_engine is not self.engine
+
+    def get_pool_stats(self) -> Dict:
+        """Pool usage per engine.
+
+        ``size``/``max_overflow`` are the configured limits, ``checked_out`` the connections in use,
+        ``overflow`` those currently open beyond ``size``, and ``checkouts``/``peak_checked_out``
+        running counters. Pools other than QueuePool only report ``checkouts``.
+        """
+        engines = {"primary": self.engine}
+        if self.has_replica:
+            engines["replica"] = self.replica_engine
+        out: Dict = {}
+        for role, engine in engines.items():
+            pool = engine.pool
+            metrics = self.pool_metrics[role]
+            stats = {"checkouts": metrics["checkouts"]}
+            if isinstance(pool, QueuePool):
+                stats.update(
+                    peak_checked_out=metrics["peak_checked_out"],
+                    checked_out=pool.checkedout(),
+                    size=pool.size(),
+                    max_overflow=self.pool_options[role]["max_overflow"],
+                    checkedin=pool.checkedin(),
+                    # QueuePool counts unopened base connections as negative overflow
+                    overflow=max(0, pool.overflow()),
+                )
+            out[role] = stats
+        return out
+
     def init_database(self):
         Base.metadata.create_all(self.engine)
         if self.using_url.startswith("sqlite"):
             print(f"✅ Database initialized at {self.using_url}")
         else:
             print(f"✅ Database initialized (URL) {self.using_url}")
+        if self.has_replica:
+            print(f"✅ Read replica configured {self.replica_engine.url.render_as_string(hide_password=True)}")
     
     def create_user(self, username: str = "Anonymous", email: Optional[str] = None) -> int:
         with self.SessionLocal() as s:
@@ -102,6 +227,8 @@ class ChatDatabase:
         with self.SessionLocal() as s:
             cs = ChatSession(user_id=user_id, session_name=session_name)
             s.add(cs)
+            s.flush()
+            self._bump_versions(s, [f"session:{cs.id}", f"user:{user_id}"])
             s.commit()
             print(f"✅ Chat session created: {session_name} (ID: {cs.id})")
             return cs.id
@@ -112,22 +239,99 @@ class ChatDatabase:
                 session_id=session_id,
                 message_type=message_type,
                 content=content,
-                metadata=json.dumps(metadata) if metadata else None,
+                message_metadata=json.dumps(metadata) if metadata else None,
             )
             s.add(m)
             # update session updated_at
             cs = s.query(ChatSession).filter_by(id=session_id).first()
             if cs:
                 cs.updated_at = dt.datetime.utcnow()
+                self._bump_versions(s, [f"session:{session_id}", f"user:{cs.user_id}"])
             s.commit()
             return int(m.id)
     
+    def save_messages(self, messages: List[Dict]) -> List[int]:
+        """Save many messages in a single transaction.
+
+        Each item needs ``session_id``, ``message_type`` and ``content``, plus optional ``metadata``.
+        """
+        with self.SessionLocal() as s:
+            rows = [
+                Message(
+                    session_id=item['session_id'],
+                    message_type=item['message_type'],
+                    content=item['content'],
+                    message_metadata=json.dumps(item['metadata']) if item.get('metadata') else None,
+                )
+                for item in messages
+            ]
+            s.add_all(rows)
+            session_ids = {item['session_id'] for item in messages}
+            if session_ids:
+                s.query(ChatSession).filter(ChatSession.id.in_(session_ids)).update(
+                    {ChatSession.updated_at: dt.datetime.utcnow()}, synchronize_session=False
+                )
+                owners = s.query(ChatSession.user_id).filter(ChatSession.id.in_(session_ids)).distinct()
+                self._bump_versions(
+                    s, [f"session:{sid}" for sid in session_ids] + [f"user:{uid}" for (uid,) in owners]
+                )
+            s.commit()
+            return [int(m.id) for m in rows]
+    
+    def _bump_versions(self, s, scopes: List[str]):
+        """Give each scope a fresh cache token inside the caller's transaction.
+
+        Upserts, so concurrent first writes to a scope can never fail the caller's commit.
+        """
+        upsert = _UPSERT_INSERTS.get(s.get_bind().dialect.name)
+        # Sorted so concurrent writers lock rows in the same order
+        for scope in sorted(set(scopes)):
+            token = uuid.uuid4().hex
+            if upsert is not None:
+                stmt = upsert(CacheVersion).values(scope=scope, token=token)
+                s.execute(stmt.on_conflict_do_update(
+                    index_elements=[CacheVersion.scope], set_={"token": stmt.excluded.token}
+                ))
+                continue
+            bump = update(CacheVersion).where(CacheVersion.scope == scope).values(token=token)
+            if s.execute(bump).rowcount == 0:
+                try:
+                    with s.begin_nested():
+                        s.add(CacheVersion(scope=scope, token=token))
+                except IntegrityError:
+                    s.execute(bump)
+    
+    def get_version(self, scope: str, use_replica: bool = False) -> Optional[str]:
+        """Current cache token for a scope, creating one for data written before tokens existed.
+
+        Returns None when the session/user behind the scope does not exist. With ``use_replica``
+        the token is read from the replica (so it matches replica-served bodies) and may be None,
+        since replicas are never written to.
+        """
+        if use_replica and self.has_replica:
+            with self.ReplicaSession() as s:
+                return s.execute(select(CacheVersion.token).where(CacheVersion.scope == scope)).scalar()
+        with self.SessionLocal() as s:
+            token = s.execute(select(CacheVersion.token).where(CacheVersion.scope == scope)).scalar()
+            if token is not None:
+                return token
+            kind, _, ident = scope.partition(":")
+            model = {"session": ChatSession, "user": User}.get(kind)
+            if model is None or not ident.isdigit() or s.get(model, int(ident)) is None:
+                return None
+            s.add(CacheVersion(scope=scope, token=uuid.uuid4().hex))
+            try:
+                s.commit()
+            except IntegrityError:
+                s.rollback()
+            return s.execute(select(CacheVersion.token).where(CacheVersion.scope == scope)).scalar_one()
+    
     def get_chat_history(self, session_id: int, limit: int = 50) -> List[Dict]:
         with self.SessionLocal() as s:
             rows: List[Message] = (
                 s.query(Message)
                 .filter_by(session_id=session_id)
-                .order_by(Message.timestamp.asc())
+                .order_by(Message.timestamp.asc(), Message.id.asc())
                 .limit(limit)
                 .all()
             )
@@ -143,8 +347,13 @@ class ChatDatabase:
                 })
             return out
     
-    def get_user_sessions(self, user_id: int) -> List[Dict]:
+    def get_user_session_ids(self, user_id: int) -> List[int]:
+        """Ids of the user's sessions, read from the primary for ownership checks"""
         with self.SessionLocal() as s:
+            return list(s.execute(select(ChatSession.id).where(ChatSession.user_id == user_id)).scalars())
+    
+    def get_user_sessions(self, user_id: int) -> List[Dict]:
+        with self.ReplicaSession() as s:
             # counts and last message time via subqueries
             msg_count = (
                 s.query(Message.session_id, func.count(Message.id).label('cnt'))
@@ -182,12 +391,67 @@ class ChatDatabase:
                 })
             return out
     
+    def get_chat_history_json(self, session_id: int, limit: int = 50) -> str:
+        """Chat history as a ready-to-send JSON document.
+
+        Reads through Core ``select()`` and writes each row straight into JSON text,
+        passing the stored metadata JSON through untouched.
+        """
+        stmt = (
+            select(Message.id, Message.message_type, Message.content, Message.timestamp, Message.message_metadata)
+            .where(Message.session_id == session_id)
+            .order_by(Message.timestamp.asc(), Message.id.asc())
+            .limit(limit)
+        )
+        parts = []
+        with self.engine.connect() as conn:
+            for mid, mtype, content, ts, meta in conn.execute(stmt):
+                parts.append(
+                    '{"id":%d,"type":%s,"content":%s,"timestamp":%s,"metadata":%s}'
+                    % (mid, _json_str(mtype), _json_str(content), _json_time(ts), meta or '{}')
+                )
+        return '{"history":[' + ','.join(parts) + ']}'
+    
+    def get_user_sessions_json(self, user_id: int) -> str:
+        """Session listing as a ready-to-send JSON document, built without the ORM"""
+        msg_stats = (
+            select(
+                Message.session_id,
+                func.count(Message.id).label('cnt'),
+                func.max(Message.timestamp).label('last'),
+            )
+            .group_by(Message.session_id)
+            .subquery()
+        )
+        stmt = (
+            select(
+                ChatSession.id,
+                ChatSession.session_name,
+                ChatSession.created_at,
+                ChatSession.updated_at,
+                func.coalesce(msg_stats.c.cnt, 0),
+                msg_stats.c.last,
+            )
+            .outerjoin(msg_stats, ChatSession.id == msg_stats.c.session_id)
+            .where(ChatSession.user_id == user_id)
+            .order_by(ChatSession.updated_at.desc())
+        )
+        parts = []
+        with self.replica_engine.connect() as conn:
+            for sid, name, created, updated, count, last in conn.execute(stmt):
+                parts.append(
+                    '{"id":%d,"name":%s,"created_at":%s,"updated_at":%s,"message_count":%d,"last_message_time":%s}'
+                    % (sid, _json_str(name), _json_time(created), _json_time(updated), count or 0, _json_time(last))
+                )
+        return '{"sessions":[' + ','.join(parts) + ']}'
+    
     def update_session_name(self, session_id: int, new_name: str):
         with self.SessionLocal() as s:
             cs = s.query(ChatSession).filter_by(id=session_id).first()
             if cs:
                 cs.session_name = new_name
                 cs.updated_at = dt.datetime.utcnow()
+                self._bump_versions(s, [f"user:{cs.user_id}"])
                 s.commit()
     
     def delete_session(self, session_id: int):
@@ -195,6 +459,8 @@ class ChatDatabase:
             cs = s.query(ChatSession).filter_by(id=session_id).first()
             if cs:
                 s.delete(cs)
+                s.query(CacheVersion).filter_by(scope=f"session:{session_id}").delete()
+                self._bump_versions(s, [f"user:{cs.user_id}"])
                 s.commit()
                 print(f"✅ Session {session_id} deleted")
     
@@ -217,12 +483,89 @@ class ChatDatabase:
             return us.setting_value if us else default
     
     def get_database_stats(self) -> Dict:
-        with self.SessionLocal() as s:
+        with self.ReplicaSession() as s:
             users = s.query(func.count(User.id)).scalar() or 0
             sessions = s.query(func.count(ChatSession.id)).scalar() or 0
             messages = s.query(func.count(Message.id)).scalar() or 0
             return {"users": users, "sessions": sessions, "messages": messages}
 
+    def consume_rate_limit_token(self, key: str, capacity: int, refill_rate: float, now: float, cost: int = 1):
+        """Take ``cost`` tokens from a shared bucket; returns (allowed, retry_after_seconds)"""
+        for _ in range(5):
+            with self.SessionLocal() as s:
+                bucket = s.get(RateLimitBucket, key)
+                if bucket is None:
+                    if cost > capacity:
+                        return False, (cost - capacity) / refill_rate
+                    s.add(RateLimitBucket(bucket_key=key, tokens=capacity - cost, updated_at=now))
+                    try:
+                        s.commit()
+                        return True, 0.0
+                    except IntegrityError:
+                        s.rollback()
+                        continue
+                tokens = min(capacity, bucket.tokens + max(0.0, now - bucket.updated_at) * refill_rate)
+                allowed = tokens >= cost
+                # Compare-and-swap on updated_at so concurrent workers never double-spend a token
+                result = s.execute(
+                    update(RateLimitBucket)
+                    .where(RateLimitBucket.bucket_key == key, RateLimitBucket.updated_at == bucket.updated_at)
+                    .values(tokens=tokens - cost if allowed else tokens, updated_at=now)
+                )
+                s.commit()
+                if result.rowcount == 1:
+                    return (True, 0.0) if allowed else (False, (cost - tokens) / refill_rate)
+        # Heavy contention on one key; treat it as exhausted rather than spin
+        return False, 1 / refill_rate
+
+    def prune_rate_limit_buckets(self, idle_before: float) -> int:
+        """Delete buckets last touched before ``idle_before``; returns how many were removed"""
+        with self.SessionLocal() as s:
+            result = s.execute(delete(RateLimitBucket).where(RateLimitBucket.updated_at < idle_before))
+            s.commit()
+            return result.rowcount
+
+    def ensure_upstream_slots(self, size: int):
+        """Create slot rows 0..size-1; rows beyond ``size`` are simply never leased"""
+        with self.SessionLocal() as s:
+            existing = set(s.execute(select(UpstreamSlot.slot_id)).scalars())
+            s.add_all(UpstreamSlot(slot_id=i, lease_until=0.0) for i in range(size) if i not in existing)
+            try:
+                s.commit()
+            except IntegrityError:
+                # Another worker created them first
+                s.rollback()
+
+    def acquire_upstream_slot(self, size: int, lease_seconds: float, now: float):
+        """Lease a free upstream slot; returns (slot_id, holder) or None when all are taken"""
+        holder = uuid.uuid4().hex
+        with self.SessionLocal() as s:
+            free = s.execute(
+                select(UpstreamSlot.slot_id)
+                .where(UpstreamSlot.slot_id < size, UpstreamSlot.lease_until <= now)
+                .order_by(UpstreamSlot.slot_id)
+            ).scalars().all()
+            for slot_id in free:
+                # Conditional update so two workers can never lease the same slot
+                result = s.execute(
+                    update(UpstreamSlot)
+                    .where(UpstreamSlot.slot_id == slot_id, UpstreamSlot.lease_until <= now)
+                    .values(holder=holder, lease_until=now + lease_seconds)
+                )
+                s.commit()
+                if result.rowcount == 1:
+                    return slot_id, holder
+        return None
+
+    def release_upstream_slot(self, slot_id: int, holder: str):
+        with self.SessionLocal() as s:
+            s.execute(
+                update(UpstreamSlot)
+                .where(UpstreamSlot.slot_id == slot_id, UpstreamSlot.holder == holder)
+                .values(holder=None, lease_until=0.0)
+            )
+            s.commit()
+
 # Initialize database instance
 db = ChatDatabase()
 
@@ -0,0 +1,201 @@
+import math
+import os
+import threading
+import time
+from functools import wraps
+from typing import Dict, Optional, Tuple
+
+from flask import jsonify, request, session
+
+
+def _parse_limit(spec: str) -> Tuple[int, float]:
+    """Parse a "<requests>/<seconds>" string into (capacity, refill per second)"""
+    count, _, period = spec.partition('/')
+    capacity = int(count)
+    seconds = float(period or 60)
+    if capacity <= 0 or seconds <= 0:
+        raise ValueError(f"Invalid rate limit: {spec!r}")
+    return capacity, capacity / seconds
+
+
+# How often idle buckets are swept out of the store
+PRUNE_INTERVAL = 60
+
+# How often a waiting caller re-checks the database for a free upstream slot
+SLOT_POLL_INTERVAL = 0.1
+
+# Default per-route limits; override with RATE_LIMIT_<ROUTE>="<requests>/<seconds>"
+DEFAULT_LIMITS = {
+    'chat': '20/60',
+    'batch': '5/60',
+    'sessions': '60/60',
+}
+
+
+class MemoryBucketStore:
+    """Token buckets held in this process only"""
+
+    def __init__(self):
+        self._buckets: Dict[str, Tuple[float, float]] = {}
+        self._lock = threading.Lock()
+
+    def consume(self, key: str, capacity: int, refill_rate: float, cost: int = 1) -> Tuple[bool, float]:
+        now = time.monotonic()
+        with self._lock:
+            tokens, updated = self._buckets.get(key, (float(capacity), now))
+            tokens = min(capacity, tokens + (now - updated) * refill_rate)
+            if tokens >= cost:
+                self._buckets[key] = (tokens - cost, now)
+                return True, 0.0
+            self._buckets[key] = (tokens, now)
+            return False, (cost - tokens) / refill_rate
+
+    def prune(self, idle_seconds: float):
+        """Drop buckets untouched for ``idle_seconds``; they have refilled, so nothing is lost"""
+        cutoff = time.monotonic() - idle_seconds
+        with self._lock:
+            for key in [k for k, (_, updated) in self._buckets.items() if updated <= cutoff]:
+                del self._buckets[key]
+
+
+class DatabaseBucketStore:
+    """Token buckets kept in the chat database so limits hold across workers"""
+
+    def __init__(self, database):
+        self.database = database
+
+    def consume(self, key: str, capacity: int, refill_rate: float, cost: int = 1) -> Tuple[bool, float]:
+        return self.database.consume_rate_limit_token(key, capacity, refill_rate, time.time(), cost)
+
+    def prune(self, idle_seconds: float):
+        self.database.prune_rate_limit_buckets(time.time() - idle_seconds)
+
+
+class MemorySlots:
+    """Upstream call slots counted in this process only"""
+
+    def __init__(self, size: int):
+        self.size = size
+        self._semaphore = threading.BoundedSemaphore(size)
+
+    def acquire(self, timeout: float = 0.0):
+        acquired = self._semaphore.acquire(timeout=timeout) if timeout > 0 else self._semaphore.acquire(blocking=False)
+        return True if acquired else None
+
+    def release(self, handle):
+        self._semaphore.release()
+
+
+class DatabaseSlots:
+    """Upstream call slots leased from the chat database, so the cap holds across workers"""
+
+    def __init__(self, database, size: int, lease_seconds: float):
+        self.database = database
+        self.size = size
+        self.lease_seconds = lease_seconds
+        database.ensure_upstream_slots(size)
+
+    def acquire(self, timeout: float = 0.0):
+        deadline = time.monotonic() + timeout
+        while True:
+            handle = self.database.acquire_upstream_slot(self.size, self.lease_seconds, time.time())
+            if handle is not None or time.monotonic() >= deadline:
+                return handle
+            time.sleep(SLOT_POLL_INTERVAL)
+
+    def release(self, handle):
+        self.database.release_upstream_slot(*handle)
+
+
+class RateLimiter:
+    def __init__(self, store, slots, limits: Optional[Dict[str, str]] = None):
+        self.store = store
+        self.limits = {
+            name: _parse_limit(os.getenv(f"RATE_LIMIT_{name.upper()}", spec))
+            for name, spec in (limits or DEFAULT_LIMITS).items()
+        }
+        self.enabled = os.getenv('RATE_LIMIT_ENABLED', 'true').lower() == 'true'
+        # An untouched bucket is full again after capacity / refill_rate seconds
+        self._refill_seconds = max((c / r for c, r in self.limits.values()), default=0.0)
+        self._next_prune = time.monotonic() + PRUNE_INTERVAL
+        self._prune_lock = threading.Lock()
+        self.slots = slots
+        self.max_inflight = slots.size
+
+    @staticmethod
+    def client_keys():
+        """Buckets charged for the caller: always the client address, plus the chat user if known.
+
+        User ids are handed out freely by ``/``, so the address bucket is what stops a client
+        that drops its cookie to start over with a full bucket.
+        """
+        keys = [f"ip:{request.remote_addr}"]
+        if 'user_id' in session:
+            keys.append(f"user:{session['user_id']}")
+        return keys
+
+    def check(self, route: str, cost: int = 1) -> Tuple[bool, float]:
+        """Take ``cost`` tokens for ``route`` from every bucket belonging to the caller"""
+        if not self.enabled or route not in self.limits:
+            return True, 0.0
+        self._maybe_prune()
+        capacity, refill_rate = self.limits[route]
+        for key in self.client_keys():
+            allowed, retry_after = self.store.consume(f"{route}:{key}", capacity, refill_rate, cost)
+            if not allowed:
+                return False, retry_after
+        return True, 0.0
+
+    def _maybe_prune(self):
+        """Sweep full buckets at most once per PRUNE_INTERVAL, so the store cannot grow without bound"""
+        now = time.monotonic()
+        if now < self._next_prune or not self._prune_lock.acquire(blocking=False):
+            return
+        try:
+            self._next_prune = now + PRUNE_INTERVAL
+            self.store.prune(self._refill_seconds)
+        finally:
+            self._prune_lock.release()
+
+    def limit(self, route: str):
+        """Decorator applying the token buckets configured for ``route``"""
+        def decorator(view):
+            @wraps(view)
+            def wrapper(*args, **kwargs):
+                allowed, retry_after = self.check(route)
+                if not allowed:
+                    return too_many_requests(retry_after)
+                return view(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def capacity(self, route: str) -> Optional[int]:
+        """Largest cost a single ``check`` can ever pass for ``route``; None when unlimited"""
+        if not self.enabled or route not in self.limits:
+            return None
+        return self.limits[route][0]
+
+    def try_acquire_upstream(self, timeout: float = 0.0):
+        """Reserve an upstream slot, waiting up to ``timeout`` seconds; returns a handle, or None to shed"""
+        return self.slots.acquire(timeout)
+
+    def release_upstream(self, handle):
+        self.slots.release(handle)
+
+
+def too_many_requests(retry_after: float, message: str = 'Too many requests, please slow down.'):
+    seconds = max(1, math.ceil(retry_after))
+    response = jsonify({'error': message, 'retry_after': seconds})
+    response.status_code = 429
+    response.headers['Retry-After'] = str(seconds)
+    return response
+
+
+def create_rate_limiter(database) -> RateLimiter:
+    """Build the limiter from environment settings"""
+    backend = os.getenv('RATE_LIMIT_BACKEND', 'memory').lower()
+    max_inflight = int(os.getenv('UPSTREAM_MAX_INFLIGHT', '4'))
+    if backend == 'database':
+        lease_seconds = float(os.getenv('UPSTREAM_LEASE_SECONDS', '30'))
+        return RateLimiter(DatabaseBucketStore(database), DatabaseSlots(database, max_inflight, lease_seconds))
+    return RateLimiter(MemoryBucketStore(), MemorySlots(max_inflight))
@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+"""
+Read/write split harness: two local SQLite files stand in for primary and replica
+"""
+import os
+import shutil
+import sqlite3
+import sys
+import tempfile
+
+tmp_dir = tempfile.mkdtemp(prefix="chatbot-replica-")
+PRIMARY = os.path.join(tmp_dir, "primary.db")
+REPLICA = os.path.join(tmp_dir, "replica.db")
+
+os.environ["DATABASE_URL"] = f"sqlite:///{PRIMARY}"
+os.environ["DATABASE_REPLICA_URL"] = f"sqlite:///{REPLICA}"
+os.environ.setdefault("DB_POOL_SIZE", "2")
+os.environ.setdefault("DB_MAX_OVERFLOW", "1")
+
+from database import db as database  # noqa: E402
+
+failures = 0
+
+
+def check(label, condition):
+    global failures
+    print(f"  {'✅' if condition else '❌'} {label}")
+    if not condition:
+        failures += 1
+
+
+def replicate():
+    """Copy primary into replica, like a replica catching up"""
+    with sqlite3.connect(PRIMARY) as src, sqlite3.connect(REPLICA) as dst:
+        src.backup(dst)
+
+
+def main():
+    replicate()
+
+    print("🧪 Routing")
+    user_id = database.create_user("ReplicaUser")
+    session_id = database.create_chat_session(user_id, "Lagging chat")
+    database.save_message(session_id, "user", "Hello, primary!")
+
+    # Replica has not caught up yet
+    check("history reads the primary", len(database.get_chat_history(session_id)) == 1)
+    check("ownership check reads the primary", session_id in database.get_user_session_ids(user_id))
+    check("version token reads the primary", database.get_version(f"session:{session_id}") is not None)
+    check("session listing reads the replica", database.get_user_sessions(user_id) == [])
+    check("replica version token not yet visible", database.get_version(f"user:{user_id}", use_replica=True) is None)
+    check("stats read the replica", database.get_database_stats()["messages"] == 0)
+
+    replicate()
+    sessions = database.get_user_sessions(user_id)
+    check("listing visible after replication", [s["id"] for s in sessions] == [session_id])
+    check("listing JSON matches", '"name":"Lagging chat"' in database.get_user_sessions_json(user_id))
+    check(
+        "replica token matches primary",
+        database.get_version(f"user:{user_id}", use_replica=True) == database.get_version(f"user:{user_id}"),
+    )
+    check("stats visible after replication", database.get_database_stats()["messages"] == 1)
+
+    print("📊 Pools")
+    pools = database.get_pool_stats()
+    for role, stats in pools.items():
+        print(f"  {role}: {stats}")
+    check("both pools reported", set(pools) == {"primary", "replica"})
+    check("pool size from DB_POOL_SIZE", pools["primary"]["size"] == int(os.environ["DB_POOL_SIZE"]))
+    check("all connections returned", all(p["checked_out"] == 0 for p in pools.values()))
+    check("replica pool was used", pools["replica"]["checkouts"] > 0)
+
+    database.engine.dispose()
+    database.replica_engine.dispose()
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    if failures:
+        print(f"❌ {failures} check(s) failed")
+        sys.exit(1)
+    print("✅ Read/write split harness passed")
+
+
+if __name__ == "__main__":
+    main()
@@ -35,6 +35,7 @@ class AdvancedChatBot {
         this.animationSpeed = 1;
         this.connectionState = 'online';
         this.lastActivity = Date.now();
+        this.etagCache = new Map(); // url -> { etag, data } for conditional GETs
         
         // Settings
         this.settings = {
@@ -262,6 +263,18 @@ class AdvancedChatBot {
                 })
             });
             
+            if (response.status === 429) {
+                const retryAfter = response.headers.get('Retry-After') || 'a few';
+                this.hideTypingIndicator();
+                this.addMessage(
+                    `You're sending messages too quickly. Please wait ${retryAfter} seconds and try again.`,
+                    'bot',
+                    'error'
+                );
+                this.updateAIStatus('Rate limited', 'error');
+                return;
+            }
+            
             if (!response.ok) {
                 throw new Error(`HTTP error! status: ${response.status}`);
             }
@@ -633,7 +646,7 @@ class AdvancedChatBot {
         
         this.healthCheckInterval = setInterval(async () => {
             try {
-                const response = await fetch('/api/health');
+                const response = await this.fetchJsonCached('/api/health');
                 if (response.ok) {
                     this.updateConnectionStatus('online');
                 } else {
@@ -714,13 +727,37 @@ class AdvancedChatBot {
         document.documentElement.style.setProperty('--animation-speed', this.animationSpeed);
     }
     
+    // Conditional GET: send the last ETag and reuse the cached body on 304
+    async fetchJsonCached(url) {
+        const cached = this.etagCache.get(url);
+        const headers = cached ? { 'If-None-Match': cached.etag } : {};
+        const response = await fetch(url, { headers, cache: 'no-store' });
+        
+        if (response.status === 304 && cached) {
+            // Hand out a copy so callers can't mutate the cached body
+            return { ok: true, status: 304, data: structuredClone(cached.data) };
+        }
+        if (!response.ok) {
+            return { ok: false, status: response.status, data: null };
+        }
+        
+        const data = await response.json();
+        const etag = response.headers.get('ETag');
+        if (etag) {
+            this.etagCache.set(url, { etag, data: structuredClone(data) });
+        } else {
+            this.etagCache.delete(url);
+        }
+        return { ok: true, status: response.status, data };
+    }
+    
     // Chat History (Database Integration)
     async loadChatHistory() {
         try {
             console.log('Loading chat history for session:', this.currentSessionId);
-            const response = await fetch('/api/history');
+            const response = await this.fetchJsonCached('/api/history');
             if (response.ok) {
-                const data = await response.json();
+                const data = response.data;
                 this.chatHistory = data.history || [];
                 console.log('Loaded chat history:', this.chatHistory.length, 'messages');
                 this.renderChatHistory();
@@ -774,9 +811,9 @@ class AdvancedChatBot {
     // Session Management
     async getCurrentSession() {
         try {
-            const response = await fetch('/api/current-session');
+            const response = await this.fetchJsonCached('/api/current-session');
             if (response.ok) {
-                const data = await response.json();
+                const data = response.data;
                 this.currentSessionId = data.session_id;
                 return data.session_id;
             }
@@ -791,9 +828,9 @@ class AdvancedChatBot {
             // Get current session first
             await this.getCurrentSession();
             
-            const response = await fetch('/api/sessions');
+            const response = await this.fetchJsonCached('/api/sessions');
             if (response.ok) {
-                const data = await response.json();
+                const data = response.data;
                 this.renderSessionList(data.sessions);
             }
         } catch (error) {